@@ -1,30 +1,384 @@
+import os
 import sys
-from collections import defaultdict
+import threading
+from array import array
+from collections import OrderedDict, defaultdict
+from types import MappingProxyType
 import logging
 
-import fitz  # PyMuPDF
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
     QFileDialog,
     QGraphicsView,
     QGraphicsScene,
+    QGraphicsItemGroup,
+    QGraphicsTextItem,
     QAction,
+    QActionGroup,
     QToolBar,
-    QInputDialog,
     QMessageBox,
 )
-from PyQt5.QtGui import QImage, QPixmap, QPen, QBrush
-from PyQt5.QtCore import Qt, QPointF, QRectF
+from PyQt5.QtGui import (
+    QImage,
+    QPixmap,
+    QPen,
+    QBrush,
+    QColor,
+    QPainter,
+    QTransform,
+)
+from PyQt5.QtCore import (
+    QPointF,
+    QRectF,
+    QObject,
+    QRunnable,
+    QThreadPool,
+    QTimer,
+    pyqtSignal,
+)
 
 
-logging.basicConfig(
-    filename="pdf_editor.log",
-    level=logging.DEBUG,
-    filemode="w",
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+def _log_level():
+    # PDFSHITBOX_LOG_LEVEL=DEBUG restores the per-action trace.
+    level = logging.getLevelName(os.environ.get("PDFSHITBOX_LOG_LEVEL", "INFO").upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+class _BufferedFileHandler(logging.FileHandler):
+    """File handler that writes the log in large chunks.
+
+    StreamHandler flushes after every record; here only warnings and errors
+    are pushed out immediately, the rest when the buffer fills, on an
+    explicit flush() or when the handler is closed at exit.
+    """
+
+    buffer_size = 65536
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=self.buffer_size,
+            encoding=self.encoding,
+            errors=self.errors,
+        )
+
+    def emit(self, record):
+        # StreamHandler.emit would flush unconditionally, so write directly.
+        try:
+            if self.stream is None:
+                self.stream = self._open()  # opened lazily (delay=True)
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.WARNING:
+                self.stream.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+# Logging is silent unless PDFSHITBOX_LOG names a file to append to, so
+# normal sessions do no disk I/O on the drawing path.
 logger = logging.getLogger(__name__)
+logger.setLevel(_log_level())
+logger.addHandler(logging.NullHandler())
+if os.environ.get("PDFSHITBOX_LOG"):
+    _file_handler = _BufferedFileHandler(os.environ["PDFSHITBOX_LOG"], delay=True)
+    _file_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    logger.addHandler(_file_handler)
+
+# Total size of the rasterized pages kept around for quick revisits.  Raster
+# size grows with the square of the zoom, so the cache is bounded in bytes;
+# the newest raster is kept even if it alone is larger.
+PIX_CACHE_BYTES = 256 << 20
+# Neighbouring pages are not prefetched when the current page's raster is
+# bigger than this (neighbours are usually the same size).
+PREFETCH_MAX_BYTES = 64 << 20
+# Thread pool priorities: the page being viewed beats speculative prefetch.
+RENDER_PRIORITY = 1
+PREFETCH_PRIORITY = 0
+# A background render does not freeze the GUI thread, but it competes with
+# it for the GIL and the CPU and makes drawing and scrolling sluggish.
+# Neighbouring pages are therefore only prefetched once the user has left
+# the current page alone for this long.
+PREFETCH_DELAY_MS = 1000
+# Pages are never rasterized beyond this scale (an A4 page at 4x is about
+# 32 MB as RGB32); past it the view stretches the capped raster instead.
+MAX_RENDER_ZOOM = 4.0
+# Share of MuPDF's resource store released after each page change.
+STORE_SHRINK_PERCENT = 50
+# Drag previews are reshaped at most once per frame (~60 Hz).
+PREVIEW_INTERVAL_MS = 16
+
+# Annotation colours as 0-255 RGB.  The QColor and the 0-1 tuple fitz
+# expects are derived once here instead of at every use.
+SHAPE_RGB = (255, 0, 0)
+FILL_RGB = (255, 255, 0)
+TEXT_RGB = (0, 0, 0)
+SHAPE_WIDTH = 2
+SHAPE_QCOLOR = QColor(*SHAPE_RGB)
+FILL_QCOLOR = QColor(*FILL_RGB)
+FILL_QBRUSH = QBrush(FILL_QCOLOR)
+TEXT_QCOLOR = QColor(*TEXT_RGB)
+PDF_SHAPE_COLOR = tuple(c / 255 for c in SHAPE_RGB)
+PDF_FILL_COLOR = tuple(c / 255 for c in FILL_RGB)
+PDF_TEXT_COLOR = tuple(c / 255 for c in TEXT_RGB)
+
+
+# ----------------------------------------------------------------------
+# Shape handlers
+#
+# Shapes are stored as (type, data) where data is (x1, y1, x2, y2) plus the
+# text for text boxes.  Each table maps a shape type to the function that
+# draws it in one place, so callers do a single lookup per shape.
+# ----------------------------------------------------------------------
+def _add_text_label(box_item, data):
+    # Parent the label to its box so both go away with one removeItem.
+    x1, y1, x2, y2, text = data
+    text_item = QGraphicsTextItem(text, box_item)
+    text_item.setDefaultTextColor(TEXT_QCOLOR)
+    text_item.setPos(x1, y1)
+    text_item.setTextWidth(x2 - x1)
+
+
+def _scene_line(scene, data, pen):
+    x1, y1, x2, y2 = data
+    return scene.addLine(x1, y1, x2, y2, pen)
+
+
+def _scene_rect(scene, data, pen):
+    x1, y1, x2, y2 = data[:4]
+    return scene.addRect(QRectF(x1, y1, x2 - x1, y2 - y1), pen)
+
+
+def _scene_filled_rect(scene, data, pen):
+    x1, y1, x2, y2 = data[:4]
+    return scene.addRect(QRectF(x1, y1, x2 - x1, y2 - y1), pen, FILL_QBRUSH)
+
+
+def _scene_ellipse(scene, data, pen):
+    x1, y1, x2, y2 = data
+    return scene.addEllipse(QRectF(x1, y1, x2 - x1, y2 - y1), pen)
+
+
+def _scene_text(scene, data, pen):
+    item = _scene_rect(scene, data, pen)
+    _add_text_label(item, data)
+    return item
+
+
+def _scene_text_fill(scene, data, pen):
+    item = _scene_filled_rect(scene, data, pen)
+    _add_text_label(item, data)
+    return item
+
+
+def _pdf_line(builder, data):
+    x1, y1, x2, y2 = data
+    builder.draw_line((x1, y1), (x2, y2))
+
+
+def _pdf_rect(builder, data):
+    x1, y1, x2, y2 = data[:4]
+    builder.draw_rect((x1, y1, x2, y2))
+
+
+def _pdf_ellipse(builder, data):
+    x1, y1, x2, y2 = data
+    builder.draw_oval((x1, y1, x2, y2))
+
+
+def _burn_shapes(page, shapes):
+    """Draw ``shapes`` onto a fitz ``page``, stacked as they are on screen.
+
+    Consecutive plain (unfilled, text-free) shapes are stroked with one
+    ``finish`` call.  A filled or text box is finished on its own, and its
+    text is committed before anything later is drawn, because a fitz Shape
+    emits all of its text after all of its graphics.  A page therefore gets
+    one content-stream update per text box plus one for the rest.
+    """
+    import fitz
+
+    builder = page.new_shape()
+    handlers, fills = PDF_HANDLERS, PDF_FILLS
+    strokes = False  # plain shapes waiting for their finish call
+    dirty = False  # builder holds something not yet committed
+    for typ, data in shapes:
+        fill = fills.get(typ)
+        is_text = typ in TEXT_TYPES
+        if fill is None and not is_text:
+            handlers[typ](builder, data)
+            strokes = dirty = True
+            continue
+        if strokes:
+            builder.finish(color=PDF_SHAPE_COLOR, width=SHAPE_WIDTH, closePath=False)
+            strokes = False
+        handlers[typ](builder, data)
+        builder.finish(
+            color=PDF_SHAPE_COLOR, fill=fill, width=SHAPE_WIDTH, closePath=False
+        )
+        dirty = True
+        if is_text:
+            x1, y1, x2, y2, text = data
+            builder.insert_textbox(
+                fitz.Rect(x1, y1, x2, y2), text, fontsize=12, color=PDF_TEXT_COLOR
+            )
+            builder.commit()
+            builder = page.new_shape()
+            dirty = False
+    if strokes:
+        builder.finish(color=PDF_SHAPE_COLOR, width=SHAPE_WIDTH, closePath=False)
+    if dirty:
+        builder.commit()
+
+
+# (scene, data, pen) -> item; used for stored shapes and new text boxes
+SCENE_HANDLERS = MappingProxyType(
+    {
+        "line": _scene_line,
+        "rect": _scene_rect,
+        "ellipse": _scene_ellipse,
+        "text": _scene_text,
+        "text_fill": _scene_text_fill,
+    }
+)
+
+# (scene, data, pen) -> item; rubber-band preview for each drawing tool
+PREVIEW_HANDLERS = MappingProxyType(
+    {
+        "line": _scene_line,
+        "rect": _scene_rect,
+        "ellipse": _scene_ellipse,
+        "text": _scene_rect,
+        "text_fill": _scene_filled_rect,
+    }
+)
+
+# (fitz.Shape, data) -> None; adds a shape's path to the page being saved
+PDF_HANDLERS = MappingProxyType(
+    {
+        "line": _pdf_line,
+        "rect": _pdf_rect,
+        "ellipse": _pdf_ellipse,
+        "text": _pdf_rect,
+        "text_fill": _pdf_rect,
+    }
+)
+
+# Fill colour of the shape types that have one when saved.
+PDF_FILLS = MappingProxyType({"text_fill": PDF_FILL_COLOR})
+TEXT_TYPES = frozenset({"text", "text_fill"})
+
+SHAPE_TYPES = ("line", "rect", "ellipse", "text", "text_fill")
+_SHAPE_CODES = MappingProxyType({typ: code for code, typ in enumerate(SHAPE_TYPES)})
+
+
+class PageShapes:
+    """Shapes drawn on one page, stored column-wise.
+
+    Coordinates are packed four per shape into one float array alongside a
+    byte array of type codes, instead of a tuple of Python floats per shape.
+    Iterating yields the usual ``(type, data)`` pairs in drawing order.
+    """
+
+    __slots__ = ("types", "coords", "texts")
+
+    def __init__(self):
+        self.types = array("B")
+        self.coords = array("f")
+        self.texts = []  # text of each shape, None for non-text shapes
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        # Walk the coordinate column four values at a time rather than
+        # slicing a new array out of it for every shape.
+        coords = iter(self.coords)
+        quads = zip(coords, coords, coords, coords)
+        for code, text, data in zip(self.types, self.texts, quads):
+            if text is not None:
+                data = (*data, text)
+            yield SHAPE_TYPES[code], data
+
+    def append(self, typ, data):
+        self.types.append(_SHAPE_CODES[typ])
+        self.coords.extend(data[:4])
+        self.texts.append(data[4] if len(data) > 4 else None)
+
+    def pop(self):
+        """Remove the most recent shape and return its type."""
+        del self.coords[-4:]
+        self.texts.pop()
+        return SHAPE_TYPES[self.types.pop()]
+
+
+def _qimage_from_pix(pix):
+    # Pages are rendered as alpha-less RGB, whose byte order is exactly what
+    # Format_RGB888 expects, so the samples are used as-is.
+    #
+    # ``samples_ptr`` points straight at MuPDF's pixel buffer, where
+    # ``samples`` would first copy it into a bytes object; older PyMuPDF
+    # versions only have the latter.
+    #
+    # Lifetime: the wrapping QImage does not own the buffer, which dies with
+    # ``pix``.  Only the converted image, which has its own pixels, may leave
+    # this function.
+    samples = getattr(pix, "samples_ptr", None) or pix.samples
+    img = QImage(samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
+    # RGB32 is the format Qt's raster painter and window surfaces use, so
+    # converting here (on the worker) spares the GUI thread a conversion pass
+    # in QPixmap.fromImage and on every paint.
+    return img.convertToFormat(QImage.Format_RGB32)
+
+
+def _pixmap_bytes(pixmap):
+    # Cached pixmaps are RGB32: four bytes per pixel.
+    return pixmap.width() * pixmap.height() * 4
+
+
+class RenderSignals(QObject):
+    """Delivers finished page renders from worker threads to the GUI thread."""
+
+    # render generation, page index, zoom, QImage (None if rendering failed)
+    rendered = pyqtSignal(int, int, float, object)
+
+
+class PageRenderTask(QRunnable):
+    """Rasterize a single page into a QImage on a thread pool worker."""
+
+    def __init__(self, doc, lock, page_index, zoom, generation, signals, cancelled):
+        super().__init__()
+        self._doc = doc
+        self._lock = lock
+        self._page_index = page_index
+        self._zoom = zoom
+        self._generation = generation
+        self._signals = signals
+        self._cancelled = cancelled  # threading.Event; set -> skip the render
+
+    def run(self):
+        import fitz
+
+        matrix = fitz.Matrix(self._zoom, self._zoom)
+        try:
+            with self._lock:
+                if self._cancelled.is_set():
+                    return
+                pix = self._doc[self._page_index].get_pixmap(
+                    matrix=matrix, colorspace=fitz.csRGB, alpha=False
+                )
+            # Outside the lock: building the image needs no MuPDF access.
+            image = _qimage_from_pix(pix)
+        except Exception:
+            logger.exception("Failed to render page %d", self._page_index + 1)
+            image = None
+        self._signals.rendered.emit(
+            self._generation, self._page_index, self._zoom, image
+        )
 
 
 class PDFGraphicsView(QGraphicsView):
@@ -36,69 +390,121 @@ class PDFGraphicsView(QGraphicsView):
         self._drawing = False
         self._start = QPointF()
         self._temp_item = None
+        # Mouse moves only record the latest position; the timer applies it
+        # to the preview so high-rate mice cannot outpace the display.
+        self._pending_end = None
+        self._update_timer = QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(PREVIEW_INTERVAL_MS)
+        self._update_timer.timeout.connect(self._apply_temp_update)
+        # Repaint only the regions that changed, and skip the extra margin
+        # Qt adds around every item in case it is antialiased.
+        self.setViewportUpdateMode(QGraphicsView.MinimalViewportUpdate)
+        self.setOptimizationFlag(QGraphicsView.DontAdjustForAntialiasing, True)
+        self._antialiasing = False
+        self._page_pixmap = None
+        self._page_rect = QRectF()
+
+    def set_page_pixmap(self, pixmap, rect=None):
+        """Show ``pixmap`` stretched over ``rect`` (scene coordinates)."""
+        rect = QRectF() if rect is None else rect
+        if pixmap is self._page_pixmap and rect == self._page_rect:
+            return
+        self._page_pixmap = pixmap
+        self._page_rect = rect
+        self.resetCachedContent()
+        self.viewport().update()
+
+    def drawBackground(self, painter, rect):
+        # The page raster is painted here rather than living in the scene, so
+        # it takes no part in item indexing, hit-testing or repaint batching.
+        super().drawBackground(painter, rect)
+        pixmap = self._page_pixmap
+        if pixmap is None:
+            return
+        painter.save()
+        target = painter.worldTransform().mapRect(self._page_rect)
+        painter.resetTransform()
+        if abs(target.width() - pixmap.width()) < 1:
+            # Raster matches the zoom: straight 1:1 blit in device pixels.
+            painter.drawPixmap(target.topLeft().toPoint(), pixmap)
+        else:
+            # Stale raster while the current zoom is rendering, or a raster
+            # capped at MAX_RENDER_ZOOM.
+            painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+        painter.restore()
 
     def mousePressEvent(self, event):
+        # Don't let speculative renders compete with the user's input.
+        self._parent.cancel_prefetch()
         if self._parent.current_tool is None:
             return super().mousePressEvent(event)
+        if self._temp_item is not None:
+            # A drag that never saw its release (e.g. focus was lost) must
+            # not hand its preview on to this one.
+            self.scene().removeItem(self._temp_item)
+            self._temp_item = None
+        if not self._drawing:
+            # The preview is throwaway; draw it without antialiasing.
+            self._antialiasing = bool(self.renderHints() & QPainter.Antialiasing)
+            self.setRenderHint(QPainter.Antialiasing, False)
         self._drawing = True
         self._start = self.mapToScene(event.pos())
         return super().mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
         if self._drawing:
-            end = self.mapToScene(event.pos())
-            if self._temp_item:
-                self.scene().removeItem(self._temp_item)
-            pen = QPen(Qt.red, 2)
-            tool = self._parent.current_tool
-            if tool == "line":
-                self._temp_item = self.scene().addLine(
-                    self._start.x(), self._start.y(), end.x(), end.y(), pen
-                )
-            elif tool in {"rect", "text", "text_fill"}:
-                rect = QRectF(self._start, end).normalized()
-                if tool == "text_fill":
-                    self._temp_item = self.scene().addRect(rect, pen, QBrush(Qt.yellow))
-                else:
-                    self._temp_item = self.scene().addRect(rect, pen)
-            elif tool == "ellipse":
-                rect = QRectF(self._start, end).normalized()
-                self._temp_item = self.scene().addEllipse(rect, pen)
+            self._pending_end = self.mapToScene(event.pos())
+            if not self._update_timer.isActive():
+                self._update_timer.start()
         return super().mouseMoveEvent(event)
 
+    def _apply_temp_update(self):
+        if self._drawing and self._pending_end is not None:
+            self._update_temp_item(self._pending_end)
+        self._pending_end = None
+
+    def _drag_data(self, end):
+        if self._parent.current_tool == "line":
+            return (self._start.x(), self._start.y(), end.x(), end.y())
+        rect = QRectF(self._start, end).normalized()
+        return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
+    def _update_temp_item(self, end):
+        # Reshape the preview in place rather than re-adding it per event.
+        tool = self._parent.current_tool
+        data = self._drag_data(end)
+        if self._temp_item is None:
+            self._temp_item = PREVIEW_HANDLERS[tool](
+                self.scene(), data, self._parent.shape_pen
+            )
+        elif tool == "line":
+            self._temp_item.setLine(*data)
+        else:
+            x1, y1, x2, y2 = data
+            self._temp_item.setRect(x1, y1, x2 - x1, y2 - y1)
+        return data
+
     def mouseReleaseEvent(self, event):
+        self._update_timer.stop()
+        self._pending_end = None
         if self._drawing:
-            end = self.mapToScene(event.pos())
-            pen = QPen(Qt.red, 2)
+            data = self._update_temp_item(self.mapToScene(event.pos()))
             tool = self._parent.current_tool
-            if self._temp_item:
+            if tool in TEXT_TYPES:
                 self.scene().removeItem(self._temp_item)
-            if tool == "line":
-                self.scene().addLine(
-                    self._start.x(), self._start.y(), end.x(), end.y(), pen
-                )
-                self._parent.add_shape(
-                    "line", (self._start.x(), self._start.y(), end.x(), end.y())
-                )
-            elif tool in {"rect", "text", "text_fill"}:
-                rect = QRectF(self._start, end).normalized()
-                if tool == "rect":
-                    self.scene().addRect(rect, pen)
-                    self._parent.add_shape(
-                        "rect",
-                        (rect.left(), rect.top(), rect.right(), rect.bottom()),
-                    )
-                else:
-                    self._parent.add_text_box(rect, fill=(tool == "text_fill"))
-            elif tool == "ellipse":
-                rect = QRectF(self._start, end).normalized()
-                self.scene().addEllipse(rect, pen)
-                self._parent.add_shape(
-                    "ellipse",
-                    (rect.left(), rect.top(), rect.right(), rect.bottom()),
+                x1, y1, x2, y2 = data
+                self._parent.add_text_box(
+                    QRectF(x1, y1, x2 - x1, y2 - y1), fill=(tool == "text_fill")
                 )
+            else:
+                # The preview already has the final geometry and pen, so it
+                # becomes the persistent item.
+                self._parent.add_shape(tool, data, self._temp_item)
+            self.setRenderHint(QPainter.Antialiasing, self._antialiasing)
         self._drawing = False
         self._temp_item = None
+        self._parent.schedule_prefetch()
         return super().mouseReleaseEvent(event)
 
 
@@ -108,12 +514,43 @@ class PDFEditor(QMainWindow):
     def __init__(self):
         super().__init__()
         self.doc = None
+        self._page_count = 0
         self.current_page = 0
         self.current_tool = None
         self.zoom = 1.0
-        self.shapes = defaultdict(list)  # page number -> list of shapes
+        # Every annotation is drawn with this pen; Qt items copy it by value,
+        # so one instance can be shared instead of building one per shape.
+        self.shape_pen = QPen(SHAPE_QCOLOR, SHAPE_WIDTH)
+        self.shapes = defaultdict(PageShapes)  # page number -> PageShapes
+        # Shapes of each visited page live in one item group that is hidden
+        # while another page is shown; _shape_items[page] holds one item per
+        # shape, parallel to self.shapes[page], so undo can remove it.
+        self._shape_groups = {}
+        self._shape_items = defaultdict(list)
+        self._shown_group = None
+        self._pix_cache = OrderedDict()  # (page number, zoom) -> QPixmap, LRU
+        self._pix_cache_bytes = 0
+
+        # MuPDF is not thread-safe: every access to self.doc that may overlap
+        # with a render task must hold this lock.  The GUI reads the page
+        # count from _page_count instead of asking the document.
+        self._doc_lock = threading.Lock()
+        self._pool = QThreadPool.globalInstance()
+        self._render_gen = 0  # bumped whenever rendered pixmaps become stale
+        # (page number, zoom) queued or rendering -> Event that cancels it
+        self._pending_renders = {}
+        self._awaiting = None  # (page number, zoom) waiting to be displayed
+        self._render_signals = RenderSignals(self)
+        self._render_signals.rendered.connect(self._on_page_rendered)
+        self._prefetch_timer = QTimer(self)
+        self._prefetch_timer.setSingleShot(True)
+        self._prefetch_timer.setInterval(PREFETCH_DELAY_MS)
+        self._prefetch_timer.timeout.connect(self._prefetch_neighbours)
 
         self.scene = QGraphicsScene()
+        # Items are only added, reshaped and removed, never searched by area,
+        # so a BSP index would just be rebuilt on every change.
+        self.scene.setItemIndexMethod(QGraphicsScene.NoIndex)
         self.view = PDFGraphicsView(self.scene, self)
         self.setCentralWidget(self.view)
         self.view.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
@@ -185,12 +622,14 @@ class PDFEditor(QMainWindow):
         toolbar.addAction(about_act)
         self.addToolBar(toolbar)
 
-        self.tool_actions = [line_act, rect_act, ell_act, text_act, text_fill_act]
+        # The group keeps exactly one tool checked, so set_tool need not.
+        self.tool_actions = QActionGroup(self)
+        self.tool_actions.setExclusive(True)
+        for action in (line_act, rect_act, ell_act, text_act, text_fill_act):
+            self.tool_actions.addAction(action)
 
     def set_tool(self, name):
         self.current_tool = name
-        for action in self.tool_actions:
-            action.setChecked(action.data() == name)
         logger.debug("Tool set to %s", name)
 
     # ------------------------------------------------------------------
@@ -202,10 +641,19 @@ class PDFEditor(QMainWindow):
             logger.info("Open file cancelled")
             return
         try:
+            # PyMuPDF is only loaded once there is a document to open, which
+            # keeps it out of the application's start-up time.
+            import fitz
+
             self.doc = fitz.open(path)
+            # Read once here: page_count (and len/bool of the document) calls
+            # into MuPDF, which must not race a render of the same document.
+            self._page_count = self.doc.page_count
+            self._invalidate_renders()
+            self._reset_scene()
             self.current_page = 0
             self.zoom = 1.0
-            logger.info("Opened PDF '%s' with %d pages", path, self.doc.page_count)
+            logger.info("Opened PDF '%s' with %d pages", path, self._page_count)
             self.load_page()
         except Exception:
             logger.exception("Failed to open PDF %s", path)
@@ -214,99 +662,223 @@ class PDFEditor(QMainWindow):
         if self.doc is None:
             logger.warning("load_page called with no document")
             return
-        try:
-            page = self.doc[self.current_page]
-            pix = page.get_pixmap()
-            image_format = (
-                QImage.Format_RGBA8888 if pix.n >= 4 else QImage.Format_RGB888
-            )
-            img = QImage(pix.samples, pix.width, pix.height, pix.stride, image_format)
-            if image_format == QImage.Format_RGB888:
-                img = img.rgbSwapped()
-            pixmap = QPixmap.fromImage(img)
-            self.scene.clear()
-            self.scene.setSceneRect(0, 0, pix.width, pix.height)
-            self.scene.addPixmap(pixmap)
-            logger.debug("Loaded page %d", self.current_page + 1)
-        except Exception:
-            logger.exception("Failed to load page %d", self.current_page)
+        group = self._shape_group(self.current_page)
+        if group is not self._shown_group:
+            if self._shown_group is not None:
+                self._shown_group.hide()
+            group.show()
+            self._shown_group = group
+            # Only a page change invalidates what is on screen; reloading the
+            # same page keeps its raster up until the replacement is ready.
+            self.view.set_page_pixmap(None)
+        self.view.setTransform(QTransform.fromScale(self.zoom, self.zoom))
+        self._update_page_pixmap()
+
+    def _page_key(self, page_index):
+        # Zoom is a product of 1.25/0.8 steps; rounding keeps float noise
+        # from splitting one zoom level into several cache entries.  Every
+        # zoom past the cap shares the one capped raster.
+        return page_index, round(min(self.zoom, MAX_RENDER_ZOOM), 4)
+
+    def _update_page_pixmap(self):
+        self._prefetch_timer.stop()
+        key = self._page_key(self.current_page)
+        # Renders for a zoom level or page the user has already moved past
+        # would only evict useful rasters; keep just the one now wanted.
+        self._cancel_renders(keep=key)
+        pixmap = self._pix_cache.get(key)
+        if pixmap is not None:
+            self._pix_cache.move_to_end(key)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Pixmap cache hit for page %d", self.current_page + 1)
+            self._awaiting = None
+            self._show_page(pixmap, key[1])
             return
 
-        # redraw existing shapes for page
-        for typ, data in self.shapes[self.current_page]:
-            pen = QPen(Qt.red, 2)
-            if typ == "line":
-                x1, y1, x2, y2 = data
-                self.scene.addLine(x1, y1, x2, y2, pen)
-            elif typ == "rect":
-                x1, y1, x2, y2 = data
-                rect = QRectF(x1, y1, x2 - x1, y2 - y1)
-                self.scene.addRect(rect, pen)
-            elif typ == "ellipse":
-                x1, y1, x2, y2 = data
-                rect = QRectF(x1, y1, x2 - x1, y2 - y1)
-                self.scene.addEllipse(rect, pen)
-            elif typ == "text":
-                x1, y1, x2, y2, text = data
-                rect = QRectF(x1, y1, x2 - x1, y2 - y1)
-                self.scene.addRect(rect, pen)
-                text_item = self.scene.addText(text)
-                text_item.setDefaultTextColor(Qt.black)
-                text_item.setPos(rect.topLeft())
-                text_item.setTextWidth(rect.width())
-            elif typ == "text_fill":
-                x1, y1, x2, y2, text = data
-                rect = QRectF(x1, y1, x2 - x1, y2 - y1)
-                self.scene.addRect(rect, pen, QBrush(Qt.yellow))
-                text_item = self.scene.addText(text)
-                text_item.setDefaultTextColor(Qt.black)
-                text_item.setPos(rect.topLeft())
-                text_item.setTextWidth(rect.width())
-
-        self.view.resetTransform()
-        self.view.scale(self.zoom, self.zoom)
-        self.setWindowTitle(f"PDF Editor - Page {self.current_page + 1}/{self.doc.page_count}")
-
-    def add_shape(self, typ, data):
-        self.shapes[self.current_page].append((typ, data))
-        logger.debug(
-            "Added shape %s with data %s on page %d",
-            typ,
-            data,
-            self.current_page + 1,
+        # Leave the shapes (and on zoom, the previous raster) up until the
+        # worker hands back the raster; _show_page then slides it in
+        # underneath them.
+        self._awaiting = key
+        self.setWindowTitle(
+            f"PDF Editor - Rendering page {self.current_page + 1}/{self._page_count}"
+        )
+        self._request_render(key, RENDER_PRIORITY)
+
+    def _request_render(self, key, priority):
+        if key in self._pix_cache or key in self._pending_renders:
+            return
+        cancelled = self._pending_renders[key] = threading.Event()
+        page_index, zoom = key
+        self._pool.start(
+            PageRenderTask(
+                self.doc,
+                self._doc_lock,
+                page_index,
+                zoom,
+                self._render_gen,
+                self._render_signals,
+                cancelled,
+            ),
+            priority,
+        )
+
+    def schedule_prefetch(self):
+        """(Re)start the idle countdown before neighbouring pages are rendered."""
+        if self.doc is not None:
+            self._prefetch_timer.start()
+
+    def cancel_prefetch(self):
+        """Drop speculative renders that have not started yet."""
+        self._prefetch_timer.stop()
+        self._cancel_renders(keep=self._awaiting)
+
+    def _cancel_renders(self, keep=None):
+        # A render that is already inside MuPDF cannot be stopped; the rest
+        # return as soon as they get the document lock.
+        for key in [key for key in self._pending_renders if key != keep]:
+            self._pending_renders.pop(key).set()
+
+    def _prefetch_neighbours(self):
+        shown = self._pix_cache.get(self._page_key(self.current_page))
+        if shown is None or _pixmap_bytes(shown) > PREFETCH_MAX_BYTES:
+            return
+        for page_index in (self.current_page + 1, self.current_page - 1):
+            if 0 <= page_index < self._page_count:
+                self._request_render(self._page_key(page_index), PREFETCH_PRIORITY)
+
+    def _invalidate_renders(self, pages=None):
+        # Drop queued tasks; tasks already running report with an old
+        # generation and are ignored by _on_page_rendered.  Cached rasters
+        # are dropped for ``pages`` only, or all of them if it is None.
+        self._pool.clear()
+        self._cancel_renders()
+        if pages is None:
+            self._pix_cache.clear()
+            self._pix_cache_bytes = 0
+        else:
+            for key in [key for key in self._pix_cache if key[0] in pages]:
+                self._pix_cache_bytes -= _pixmap_bytes(self._pix_cache.pop(key))
+        self._render_gen += 1
+
+    def _on_page_rendered(self, generation, page_index, zoom, image):
+        if generation != self._render_gen:
+            logger.debug("Discarding stale render of page %d", page_index + 1)
+            return
+        key = (page_index, zoom)
+        self._pending_renders.pop(key, None)
+        if image is None:
+            if key == self._awaiting:
+                # Nothing more is coming for this page; stop showing it as
+                # in progress.  Revisiting the page will try again.
+                self._awaiting = None
+                self.setWindowTitle(
+                    f"PDF Editor - Page {self.current_page + 1}/{self._page_count}"
+                )
+            return
+        # QPixmap lives in the windowing system and may only be made here, on
+        # the GUI thread; everything before it was done by the worker.
+        pixmap = QPixmap.fromImage(image)
+        replaced = self._pix_cache.pop(key, None)
+        if replaced is not None:
+            # A cancelled render that had already started can land twice.
+            self._pix_cache_bytes -= _pixmap_bytes(replaced)
+        self._pix_cache[key] = pixmap
+        self._pix_cache_bytes += _pixmap_bytes(pixmap)
+        while self._pix_cache_bytes > PIX_CACHE_BYTES and len(self._pix_cache) > 1:
+            _, evicted = self._pix_cache.popitem(last=False)
+            self._pix_cache_bytes -= _pixmap_bytes(evicted)
+        if key == self._awaiting:
+            self._awaiting = None
+            self._show_page(pixmap, zoom)
+        else:
+            logger.debug("Prefetched page %d at zoom %f", page_index + 1, zoom)
+
+    def _show_page(self, pixmap, render_zoom):
+        # The raster is render_zoom times the page size.  Mapping it onto the
+        # page rect keeps the scene in page coordinates (shapes and mouse
+        # input are unaffected); the view's zoom then brings it back to 1:1,
+        # or stretches it when the zoom is past MAX_RENDER_ZOOM.
+        page_rect = QRectF(
+            0, 0, pixmap.width() / render_zoom, pixmap.height() / render_zoom
         )
+        self.view.set_page_pixmap(pixmap, page_rect)
+        self.scene.setSceneRect(page_rect)
+        logger.debug("Loaded page %d", self.current_page + 1)
+        self.setWindowTitle(f"PDF Editor - Page {self.current_page + 1}/{self._page_count}")
+        self.schedule_prefetch()
+
+    def _reset_scene(self):
+        self.scene.clear()
+        self._shape_groups.clear()
+        self._shape_items.clear()
+        self._shown_group = None
+
+    def _shape_group(self, page_index):
+        group = self._shape_groups.get(page_index)
+        if group is not None:
+            return group
+        group = QGraphicsItemGroup()
+        self.scene.addItem(group)
+        items = self._shape_items[page_index] = []
+        # Bind what the loop touches to locals: one lookup per page instead
+        # of global/attribute lookups per shape.
+        handlers, scene, pen = SCENE_HANDLERS, self.scene, self.shape_pen
+        add_to_group, append = group.addToGroup, items.append
+        for typ, data in self.shapes[page_index]:
+            item = handlers[typ](scene, data, pen)
+            add_to_group(item)
+            append(item)
+        self._shape_groups[page_index] = group
+        return group
+
+    def add_shape(self, typ, data, item):
+        self._shape_group(self.current_page).addToGroup(item)
+        self.shapes[self.current_page].append(typ, data)
+        self._shape_items[self.current_page].append(item)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Added shape %s with data %s on page %d",
+                typ,
+                data,
+                self.current_page + 1,
+            )
 
     def add_text_box(self, rect, fill=False):
+        from PyQt5.QtWidgets import QInputDialog
+
         text, ok = QInputDialog.getText(self, "Text", "Enter text:")
         if not ok:
             logger.info("Text box cancelled")
             return
-        pen = QPen(Qt.red, 2)
-        brush = QBrush(Qt.yellow) if fill else QBrush(Qt.transparent)
-        self.scene.addRect(rect, pen, brush)
-        text_item = self.scene.addText(text)
-        text_item.setDefaultTextColor(Qt.black)
-        text_item.setPos(rect.topLeft())
-        text_item.setTextWidth(rect.width())
-        self.add_shape(
-            "text_fill" if fill else "text",
-            (rect.left(), rect.top(), rect.right(), rect.bottom(), text),
-        )
-        logger.debug(
-            "Added text box with fill=%s and text '%s' on page %d",
-            fill,
-            text,
-            self.current_page + 1,
-        )
+        typ = "text_fill" if fill else "text"
+        data = (rect.left(), rect.top(), rect.right(), rect.bottom(), text)
+        item = SCENE_HANDLERS[typ](self.scene, data, self.shape_pen)
+        self.add_shape(typ, data, item)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Added text box with fill=%s and text '%s' on page %d",
+                fill,
+                text,
+                self.current_page + 1,
+            )
 
     def undo_last(self):
         shapes = self.shapes[self.current_page]
         if shapes:
+            group = self._shape_group(self.current_page)
+            items = self._shape_items[self.current_page]
+            assert len(items) == len(shapes), "shape items out of sync"
+            # Only the undone shape's item changes; the page pixmap and the
+            # other shapes stay in the scene untouched.
             removed = shapes.pop()
-            logger.debug(
-                "Undo shape %s on page %d", removed[0], self.current_page + 1
-            )
-            self.load_page()
+            item = items.pop()
+            assert item is not None
+            group.removeFromGroup(item)
+            self.scene.removeItem(item)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Undo shape %s on page %d", removed, self.current_page + 1
+                )
         else:
             logger.info(
                 "Undo requested but no shapes on page %d", self.current_page + 1
@@ -316,28 +888,52 @@ class PDFEditor(QMainWindow):
         self.zoom *= 1.25
         self.view.scale(1.25, 1.25)
         logger.debug("Zoomed in to %f", self.zoom)
+        if self.doc is not None:
+            self._update_page_pixmap()
 
     def zoom_out(self):
         self.zoom *= 0.8
         self.view.scale(0.8, 0.8)
         logger.debug("Zoomed out to %f", self.zoom)
+        if self.doc is not None:
+            self._update_page_pixmap()
 
     def next_page(self):
-        if self.doc and self.current_page + 1 < self.doc.page_count:
+        if self.doc is not None and self.current_page + 1 < self._page_count:
             self.current_page += 1
             logger.debug("Navigated to next page %d", self.current_page + 1)
             self.load_page()
+            self._shrink_store()
         else:
             logger.info("Next page requested but at end or no document")
 
     def prev_page(self):
-        if self.doc and self.current_page > 0:
+        if self.doc is not None and self.current_page > 0:
             self.current_page -= 1
             logger.debug("Navigated to previous page %d", self.current_page + 1)
             self.load_page()
+            self._shrink_store()
         else:
             logger.info("Previous page requested but at beginning or no document")
 
+    def _shrink_store(self):
+        # MuPDF keeps fonts and images of every page it has rendered; trim
+        # that store as the user moves on so long sessions stay bounded.
+        # The store is shared with the render workers, so only do this when
+        # none of them is using MuPDF rather than stall the GUI thread.
+        if not self._doc_lock.acquire(blocking=False):
+            return
+        try:
+            import fitz
+
+            fitz.TOOLS.store_shrink(STORE_SHRINK_PERCENT)
+            logger.debug("Shrank MuPDF store by %d%%", STORE_SHRINK_PERCENT)
+        except Exception:
+            # Not offered by every PyMuPDF version; the store is only a cache.
+            logger.debug("Could not shrink the MuPDF store", exc_info=True)
+        finally:
+            self._doc_lock.release()
+
     def save_file(self):
         if self.doc is None:
             logger.warning("save_file called with no document")
@@ -347,42 +943,18 @@ class PDFEditor(QMainWindow):
             logger.info("Save file cancelled")
             return
         try:
-            for page_number, shapes in self.shapes.items():
-                page = self.doc[page_number]
-                for typ, data in shapes:
-                    if typ == "line":
-                        x1, y1, x2, y2 = data
-                        page.draw_line((x1, y1), (x2, y2), color=(1, 0, 0), width=2)
-                    elif typ == "rect":
-                        x1, y1, x2, y2 = data
-                        page.draw_rect([x1, y1, x2, y2], color=(1, 0, 0), width=2)
-                    elif typ == "ellipse":
-                        x1, y1, x2, y2 = data
-                        page.draw_oval([x1, y1, x2, y2], color=(1, 0, 0), width=2)
-                    elif typ == "text":
-                        x1, y1, x2, y2, text = data
-                        page.draw_rect([x1, y1, x2, y2], color=(1, 0, 0), width=2)
-                        page.insert_textbox(
-                            fitz.Rect(x1, y1, x2, y2),
-                            text,
-                            fontsize=12,
-                            color=(0, 0, 0),
-                        )
-                    elif typ == "text_fill":
-                        x1, y1, x2, y2, text = data
-                        page.draw_rect(
-                            [x1, y1, x2, y2],
-                            color=(1, 0, 0),
-                            width=2,
-                            fill=(1, 1, 0),
-                        )
-                        page.insert_textbox(
-                            fitz.Rect(x1, y1, x2, y2),
-                            text,
-                            fontsize=12,
-                            color=(0, 0, 0),
-                        )
-            self.doc.save(path)
+            changed = set()
+            with self._doc_lock:
+                for page_number, shapes in self.shapes.items():
+                    if shapes:
+                        _burn_shapes(self.doc[page_number], shapes)
+                        changed.add(page_number)
+                self.doc.save(path)
+            # Annotations are now part of those pages' content; re-render them
+            # on demand.  Untouched pages keep their cached rasters.
+            self._invalidate_renders(changed)
+            if self._awaiting is not None:
+                self.load_page()
             logger.info("Saved PDF as %s", path)
         except Exception:
             logger.exception("Failed to save PDF %s", path)